@@ -2,53 +2,365 @@
 import os
 import sys
 import json
+import re
+import time
+import hashlib
+import functools
+import sqlite3
 import subprocess
-import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from anthropic import Anthropic
 
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either
+    _loads = json.loads
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+@functools.lru_cache(maxsize=1)
 def get_base_ref():
     """Base branch to diff against (e.g. main, master). Set by workflow or default to main."""
     return os.environ.get('BASE_REF', 'main')
 
-def get_diff():
-    """Get the PR diff"""
-    base = get_base_ref()
-    result = subprocess.run(
-        ['git', 'diff', f'origin/{base}...HEAD'],
-        capture_output=True,
-        text=True
+# Matches the diff lines that carry file paths or hunk positions in the raw
+# diff bytes: "diff --git", "+++"/"rename to"/"copy to", and "@@" hunk headers.
+_DIFF_MARKER_RE = re.compile(
+    rb'^(?:diff --git (.+)|(\+\+\+ |rename to |copy to )(.+)|@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@)',
+    re.M
+)
+_SEVERITY_EMOJI = {'critical': '🚨', 'high': '⚠️', 'medium': '⚡', 'low': 'ℹ️'}
+# Prefer an explicit ```json fence; a bare fence is only the fallback, so a
+# ```swift example earlier in the reply is never mistaken for the JSON
+_JSON_FENCE_RE = re.compile(r'```json\s*(.*?)```', re.S)
+_FENCE_RE = re.compile(r'```(?![A-Za-z])\s*(.*?)```', re.S)
+
+# Review checklist sections; only those matching the changed files go in the prompt
+_GUIDELINE_BLOCKS = {
+    'security': """## Security (CRITICAL for mDL wallet):
+- Are private keys stored only in Keychain, never in UserDefaults or files?
+- Are there any hardcoded secrets or test keys?
+- Is sensitive data being logged?
+- Is input validation thorough for all external data?""",
+    'crypto': """## Cryptography:
+- Are cryptographic operations using CryptoKit correctly?
+- Are there timing attack vulnerabilities in crypto code?""",
+    'swift': """## Swift Best Practices:
+- Are optionals handled safely (no force unwrapping without justification)?
+- Is error handling appropriate (Result vs throws)?
+- Are structs used for data models (value semantics)?
+- Are actors used correctly for mutable shared state?
+- Is Sendable conformance correct?
+- Are there any retain cycles (@weak, @unowned)?""",
+    'iso': """## ISO 18013-5 Compliance:
+- Does CBOR encoding/decoding follow the spec?
+- Are data elements named correctly per the standard?
+- Is device engagement implemented correctly?
+- Are security requirements from the spec followed?""",
+    'testing': """## Testing:
+- Are there tests for the changed code?
+- Are edge cases covered?
+- Are error conditions tested?
+- Are crypto operations using test keys (not real keys)?""",
+    'quality': """## Code Quality:
+- Is the code overly complex where simpler would work?
+- Are there duplicated patterns that should be abstracted?
+- Are naming conventions followed?
+- Is there adequate documentation?
+- Are there any "AI-isms" (overly verbose, unnecessary abstractions)?""",
+    'docs': """## Documentation:
+- Does the documentation match the code changed in this PR?
+- Are any instructions, paths or examples now out of date?""",
+}
+# File name fragments that pull in the crypto / ISO 18013-5 sections
+_CRYPTO_MARKERS = ('Crypto', 'Key', 'Sign', 'Secure', 'MSO', 'MobileSecurityObject', 'COSE', 'Digest')
+_ISO_MARKERS = ('CBOR', 'MDL', 'MSO', 'MobileSecurityObject', 'DeviceEngagement')
+
+# Lines of surrounding context kept either side of each diff hunk
+CONTEXT_LINES = 50
+# Read size when streaming `git diff` output
+DIFF_CHUNK_BYTES = 64 * 1024
+# Hard cap on the size of the diff plus file context sent to Claude
+MAX_PROMPT_BYTES = 120_000
+
+# Abort the Claude stream if the reply grows past this (4000 tokens is ~16k chars)
+MAX_RESPONSE_CHARS = 64_000
+
+# Shared keep-alive session for all GitHub API calls
+SESSION = requests.Session()
+SESSION.headers.update({
+    'Accept': 'application/vnd.github+json',
+    'X-GitHub-Api-Version': '2022-11-28',
+    'Content-Type': 'application/json',
+})
+
+REVIEW_MODEL = "claude-sonnet-4-20250514"
+
+# Reviews are cached by prompt hash so re-runs on an unchanged diff skip Claude
+CACHE_DIR = os.environ.get('AI_REVIEW_CACHE_DIR', os.path.expanduser('~/.cache/ai_review'))
+# Cached reviews older than this are pruned on each insert so the DB stays small
+CACHE_MAX_AGE_DAYS = 14
+
+_C_ESCAPES = {b'a': 7, b'b': 8, b't': 9, b'n': 10, b'v': 11, b'f': 12, b'r': 13, b'"': 34, b'\\': 92}
+_C_ESCAPE_RE = re.compile(rb'\\([0-7]{3}|.)', re.S)
+
+def _unquote_git_path(path):
+    """Undo git's C-style quoting ("tab\\tx.swift") of paths with special characters."""
+    if len(path) < 2 or not (path.startswith(b'"') and path.endswith(b'"')):
+        return path
+    def unescape(m):
+        esc = m.group(1)
+        if len(esc) == 3:
+            return bytes([int(esc, 8)])
+        return bytes([_C_ESCAPES.get(esc, esc[0])])
+    return _C_ESCAPE_RE.sub(unescape, path[1:-1])
+
+def _diff_header_path(rest):
+    """Path from the part of a "diff --git" line after the command, or None.
+
+    Only unambiguous when both halves name the same file ("a/X b/X"), so split
+    at the midpoint; renames and copies are resolved from later header lines.
+    """
+    if len(rest) % 2 == 0:
+        return None
+    half = len(rest) // 2
+    left, sep, right = rest[:half], rest[half:half + 1], rest[half + 1:]
+    if sep != b' ':
+        return None
+    left, right = _unquote_git_path(left), _unquote_git_path(right)
+    if left.startswith(b'a/') and right.startswith(b'b/') and left[2:] == right[2:]:
+        return right[2:]
+    return None
+
+def _extended_header_path(kind, path):
+    """New-side path from a "+++ b/X", "rename to X" or "copy to X" line, or None."""
+    if kind == b'+++ ':
+        # "+++ /dev/null" for deletions; git appends a tab when the path has spaces
+        path = _unquote_git_path(path.rstrip(b'\t'))
+        return path[2:] if path.startswith(b'b/') else None
+    return _unquote_git_path(path)
+
+def get_diff(base):
+    """Stream the PR diff, collecting hunk ranges while git is still producing it.
+
+    Returns the decoded diff text and a dict mapping each file's raw path (b/
+    side, so renames resolve to the new path) to its new-side (start, end) hunk
+    ranges. The raw bytes are decoded once here rather than copied and kept.
+    """
+    # quotePath=false keeps non-ASCII paths verbatim in the diff headers
+    proc = subprocess.Popen(
+        ['git', '-c', 'core.quotePath=false', 'diff', f'origin/{base}...HEAD'],
+        stdout=subprocess.PIPE,
+        bufsize=1024 * 1024
     )
-    return result.stdout
-
-def get_changed_files():
-    """Get list of changed Swift files"""
-    base = get_base_ref()
-    result = subprocess.run(
-        ['git', 'diff', '--name-only', f'origin/{base}...HEAD'],
-        capture_output=True,
-        text=True
+    buf = bytearray()
+    ranges = {}
+    current = None
+    scanned = 0
+
+    in_header = False
+
+    def scan(end):
+        nonlocal current, in_header
+        for m in _DIFF_MARKER_RE.finditer(buf, scanned, end):
+            if m.group(1) is not None:
+                in_header = True
+                path = _diff_header_path(m.group(1))
+                current = ranges.setdefault(path, []) if path is not None else None
+            elif m.group(2) is not None:
+                # Only trust these before the first hunk; inside a hunk an added
+                # line starting "++ b/" would otherwise look like a "+++" line
+                if in_header and current is None:
+                    path = _extended_header_path(m.group(2), m.group(3))
+                    if path is not None:
+                        current = ranges.setdefault(path, [])
+            else:
+                in_header = False
+                if current is not None:
+                    start = int(m.group(4))
+                    count = int(m.group(5)) if m.group(5) is not None else 1
+                    current.append((start, start + max(count, 1) - 1))
+
+    for chunk in iter(lambda: proc.stdout.read(DIFF_CHUNK_BYTES), b''):
+        buf += chunk
+        # Only scan complete lines; a partial line is picked up with the next chunk
+        end = buf.rfind(b'\n', scanned)
+        if end != -1:
+            scan(end)
+            scanned = end + 1
+    scan(len(buf))
+    proc.stdout.close()
+    proc.wait()
+    return buf.decode('utf-8', errors='replace'), ranges
+
+def get_changed_files(hunk_ranges):
+    """Get list of changed Swift/Markdown files, decoding only paths that match."""
+    return [
+        os.fsdecode(path) for path in hunk_ranges
+        if path.endswith((b'.swift', b'.md'))
+    ]
+
+def get_file_contents(filepaths):
+    """Get HEAD content of each file using a single `git cat-file --batch` process.
+
+    Files missing at HEAD (e.g. deleted in the PR) map to None, as do paths
+    containing a newline, which the line-based batch protocol cannot request.
+    """
+    contents = {filepath: None for filepath in filepaths}
+    requested = [filepath for filepath in filepaths if '\n' not in filepath]
+    proc = subprocess.Popen(
+        ['git', 'cat-file', '--batch=%(objectname) %(objecttype) %(objectsize)'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE
     )
-    files = result.stdout.strip().split('\n')
-    return [f for f in files if f.endswith('.swift') or f.endswith('.md')]
+    # Feed refs from a thread so a large batch can't deadlock on full pipes
+    def feed():
+        for filepath in requested:
+            proc.stdin.write(b"HEAD:" + os.fsencode(filepath) + b"\n")
+        proc.stdin.close()
+    writer = threading.Thread(target=feed)
+    writer.start()
+
+    for filepath in requested:
+        line = proc.stdout.readline().rstrip(b'\n')
+        # "HEAD:<path> missing" / "ambiguous"; the path may itself contain spaces
+        if line.endswith((b' missing', b' ambiguous')):
+            contents[filepath] = None
+            continue
+        _, objtype, size = line.rsplit(b' ', 2)
+        if objtype != b'blob':
+            proc.stdout.read(int(size) + 1)
+            contents[filepath] = None
+            continue
+        data = proc.stdout.read(int(size))
+        proc.stdout.read(1)  # trailing newline
+        contents[filepath] = data.decode('utf-8', errors='replace')
+
+    writer.join()
+    proc.stdout.close()
+    proc.wait()
+    return contents
+
+def _trim_diff(diff, budget):
+    """Keep whole per-file sections of the diff while they fit in `budget` bytes.
+
+    Files past the budget keep only their header lines up to the first hunk,
+    plus a marker, so Claude still sees which files changed. Returns the text
+    and the number of bytes used.
+    """
+    sections = re.split(r'(?m)^(?=diff --git )', diff)
+    out = []
+    total = 0
+    for section in sections:
+        size = len(section.encode('utf-8'))
+        if total + size > budget:
+            header = section.split('\n@@', 1)[0]
+            section = f"{header}\n(diff for this file omitted: exceeds {MAX_PROMPT_BYTES} byte prompt budget)\n"
+            size = len(section.encode('utf-8'))
+        out.append(section)
+        total += size
+    return ''.join(out), total
+
+def _trim_context(file_contents, hunk_ranges, budget):
+    """Build the file context block, keeping only lines near diff hunks.
+
+    Omitted stretches are replaced by a marker naming the skipped line numbers
+    so Claude can still report absolute line numbers. Files are dropped once
+    the total exceeds `budget` bytes.
+    """
+    blocks = []
+    total = 0
+    for filepath, content in file_contents.items():
+        if not content:
+            continue
+        lines = content.splitlines()
+        keep = set()
+        for start, end in hunk_ranges.get(os.fsencode(filepath), []):
+            keep.update(range(max(start - CONTEXT_LINES, 1), min(end + CONTEXT_LINES, len(lines)) + 1))
+
+        out = []
+        skipped_from = None
+        for lineno, text in enumerate(lines, start=1):
+            if lineno in keep:
+                if skipped_from is not None:
+                    out.append(f"// ... lines {skipped_from}-{lineno - 1} omitted ...")
+                    skipped_from = None
+                out.append(text)
+            elif skipped_from is None:
+                skipped_from = lineno
+        if skipped_from is not None and out:
+            out.append(f"// ... lines {skipped_from}-{len(lines)} omitted ...")
+        if not out:
+            continue
 
-def get_file_content(filepath):
-    """Get content of a specific file"""
+        display_path = os.fsencode(filepath).decode('utf-8', errors='replace')
+        block = f"File: {display_path}\n```swift\n" + "\n".join(out) + "\n```"
+        size = len(block.encode('utf-8'))
+        if total + size > budget:
+            blocks.append(f"(Remaining file context omitted: exceeds {MAX_PROMPT_BYTES} byte prompt budget)")
+            break
+        blocks.append(block)
+        total += size
+    return "\n\n".join(blocks)
+
+def _cache_key(model, prompt):
+    """Hash of the model and the exact prompt sent to it that identifies a review.
+
+    Hashing the final prompt means template or guideline changes invalidate
+    old entries, not just changes to the diff.
+    """
+    h = hashlib.sha256(model.encode('utf-8'))
+    h.update(b"\0" + prompt.encode('utf-8'))
+    return h.hexdigest()
+
+def _open_cache():
+    """Open (creating if needed) the review cache DB; None if unavailable."""
     try:
-        with open(filepath, 'r') as f:
-            return f.read()
-    except:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        db = sqlite3.connect(os.path.join(CACHE_DIR, 'reviews.sqlite3'))
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS reviews ("
+            "key TEXT PRIMARY KEY, head_sha TEXT, review_text TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+        return db
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: review cache unavailable: {e}")
         return None
 
-def review_code(diff, changed_files, file_contents):
-    """Send code to Claude for review"""
-    client = Anthropic(api_key=os.environ['ANTHROPIC_API_KEY'])
-    
+def _guideline_categories(filepath):
+    """Which _GUIDELINE_BLOCKS apply to a single changed file."""
+    name = os.path.basename(filepath)
+    if name.endswith('.md'):
+        return {'docs'}
+    if not name.endswith('.swift'):
+        return set()
+    # Testing applies to production code too: changes there should come with tests
+    categories = {'security', 'swift', 'testing', 'quality'}
+    if any(marker in name for marker in _CRYPTO_MARKERS):
+        categories.add('crypto')
+    if any(marker in name for marker in _ISO_MARKERS):
+        categories.add('iso')
+    return categories
+
+def _guidelines_for(changed_files):
+    """Build the review guidelines from only the blocks relevant to the changed files."""
+    categories = set()
+    for filepath in changed_files:
+        categories |= _guideline_categories(filepath)
+    return "\n\n".join(block for name, block in _GUIDELINE_BLOCKS.items() if name in categories)
+
+def review_code(diff, changed_files, file_contents, hunk_ranges):
+    """Send code to Claude for review, reusing a cached review for identical input"""
     # Build context
-    files_context = "\n\n".join([
-        f"File: {filepath}\n```swift\n{content}\n```"
-        for filepath, content in file_contents.items()
-        if content
-    ])
+    # The diff is what is being reviewed, so it gets first claim on the budget
+    diff, diff_bytes = _trim_diff(diff, MAX_PROMPT_BYTES)
+    files_context = _trim_context(file_contents, hunk_ranges, MAX_PROMPT_BYTES - diff_bytes)
+    guidelines = _guidelines_for(changed_files)
     
     prompt = f"""You are performing an adversarial code review for an mDL (mobile driver's license) wallet app written in Swift.
 
@@ -64,40 +376,7 @@ This code may have been generated or suggested by AI tools like Cursor. Your job
 
 # Review Guidelines:
 
-## Security (CRITICAL for mDL wallet):
-- Are cryptographic operations using CryptoKit correctly?
-- Are private keys stored only in Keychain, never in UserDefaults or files?
-- Are there any hardcoded secrets or test keys?
-- Is sensitive data being logged?
-- Are there timing attack vulnerabilities in crypto code?
-- Is input validation thorough for all external data?
-
-## Swift Best Practices:
-- Are optionals handled safely (no force unwrapping without justification)?
-- Is error handling appropriate (Result vs throws)?
-- Are structs used for data models (value semantics)?
-- Are actors used correctly for mutable shared state?
-- Is Sendable conformance correct?
-- Are there any retain cycles (@weak, @unowned)?
-
-## ISO 18013-5 Compliance:
-- Does CBOR encoding/decoding follow the spec?
-- Are data elements named correctly per the standard?
-- Is device engagement implemented correctly?
-- Are security requirements from the spec followed?
-
-## Testing:
-- Are there tests for the changed code?
-- Are edge cases covered?
-- Are error conditions tested?
-- Are crypto operations using test keys (not real keys)?
-
-## Code Quality:
-- Is the code overly complex where simpler would work?
-- Are there duplicated patterns that should be abstracted?
-- Are naming conventions followed?
-- Is there adequate documentation?
-- Are there any "AI-isms" (overly verbose, unnecessary abstractions)?
+{guidelines}
 
 # Output Format:
 
@@ -125,61 +404,104 @@ Provide your review in this JSON format. You MUST include "line" (integer, 1-bas
 Be thorough but fair. Flag real issues, not stylistic nitpicks unless they impact security or maintainability. Always set "line" to the exact line number in the file where the issue applies (1-based).
 """
     
-    message = client.messages.create(
-        model="claude-sonnet-4-20250514",
+    key = _cache_key(REVIEW_MODEL, prompt)
+    cache = _open_cache()
+    if cache is not None:
+        row = cache.execute("SELECT review_text FROM reviews WHERE key = ?", (key,)).fetchone()
+        if row:
+            print("Using cached review for identical prompt")
+            cache.close()
+            return row[0]
+
+    client = Anthropic(api_key=os.environ['ANTHROPIC_API_KEY'])
+    buf = []
+    received = 0
+    with client.messages.stream(
+        model=REVIEW_MODEL,
         max_tokens=4000,
         messages=[{"role": "user", "content": prompt}]
-    )
+    ) as stream:
+        for text in stream.text_stream:
+            buf.append(text)
+            received += len(text)
+            if received > MAX_RESPONSE_CHARS:
+                print(f"Warning: response exceeded {MAX_RESPONSE_CHARS} chars, stopping stream")
+                break
     
-    return message.content[0].text
+    review_text = ''.join(buf)
+    if cache is not None:
+        try:
+            parse_review(review_text)  # never cache a malformed response
+            with cache:
+                cache.execute(
+                    "DELETE FROM reviews WHERE ts < ?",
+                    (time.time() - CACHE_MAX_AGE_DAYS * 86400,)
+                )
+                cache.execute(
+                    "INSERT OR REPLACE INTO reviews (key, head_sha, review_text, ts) VALUES (?, ?, ?, ?)",
+                    (key, os.environ.get('HEAD_SHA', '').strip() or None, review_text, time.time())
+                )
+        except json.JSONDecodeError:
+            pass
+        except sqlite3.Error as e:
+            print(f"Warning: could not cache review: {e}")
+        cache.close()
+    return review_text
 
 def parse_review(review_text):
     """Parse Claude's JSON response"""
     # Claude might wrap JSON in markdown code blocks
-    if "```json" in review_text:
-        start = review_text.find("```json") + 7
-        end = review_text.find("```", start)
-        review_text = review_text[start:end].strip()
-    elif "```" in review_text:
-        start = review_text.find("```") + 3
-        end = review_text.find("```", start)
-        review_text = review_text[start:end].strip()
+    m = _JSON_FENCE_RE.search(review_text) or _FENCE_RE.search(review_text)
+    if m:
+        review_text = m.group(1)
     
-    return json.loads(review_text)
+    return _loads(review_text)
 
 def _inline_comment_body(issue):
     """Build markdown body for a single inline comment."""
-    emoji = {'critical': '🚨', 'high': '⚠️', 'medium': '⚡', 'low': 'ℹ️'}.get(issue['severity'], 'ℹ️')
-    body = f"{emoji} **{issue['title']}** ({issue['severity']}) — *{issue['category']}*\n\n"
-    body += issue['description'] + "\n"
+    emoji = _SEVERITY_EMOJI.get(issue['severity'], 'ℹ️')
+    parts = [f"{emoji} **{issue['title']}** ({issue['severity']}) — *{issue['category']}*\n\n"]
+    parts.append(issue['description'] + "\n")
     if issue.get('suggestion'):
-        body += "\n**Suggestion:** " + issue['suggestion'] + "\n"
+        parts.append("\n**Suggestion:** " + issue['suggestion'] + "\n")
     if issue.get('code_example'):
-        body += "\n```swift\n" + issue['code_example'] + "\n```\n"
-    return body
+        parts.append("\n```swift\n" + issue['code_example'] + "\n```\n")
+    return ''.join(parts)
 
 
 def _review_body_summary(review_data, issues_without_line):
-    """Build the top-level review body (summary + issues that have no line)."""
+    """Build the top-level review body (summary + issues not posted as inline comments)."""
     summary = review_data.get('summary', '')
     severity = review_data.get('severity', 'low')
     positive = review_data.get('positive_notes', [])
-    body = f"""## 🤖 AI Code Review
+    parts = [f"""## 🤖 AI Code Review
 
 **Summary:** {summary}
 
 **Overall Severity:** {severity.upper()}
-"""
+"""]
     if issues_without_line:
-        body += "\n### Issues (no specific line)\n\n"
+        parts.append("\n### Issues not posted inline\n\n")
         for issue in issues_without_line:
-            body += _inline_comment_body(issue) + "\n"
+            # Inline comments that could not be posted keep their location here
+            if issue.get('file') and issue.get('line'):
+                parts.append(f"**`{issue['file']}:{issue['line']}`**\n\n")
+            parts.append(_inline_comment_body(issue) + "\n")
     if positive:
-        body += "\n### ✅ Positive Notes\n\n"
+        parts.append("\n### ✅ Positive Notes\n\n")
         for note in positive:
-            body += f"- {note}\n"
-    body += "\n---\n*This review was performed by Claude AI. Please verify all suggestions.*"
-    return body
+            parts.append(f"- {note}\n")
+    parts.append("\n---\n*This review was performed by Claude AI. Please verify all suggestions.*")
+    return ''.join(parts)
+
+
+def _post_inline_comment(url, head_sha, comment):
+    """Post one inline comment via POST /pulls/{n}/comments. Returns True on success."""
+    resp = SESSION.post(url, data=_dumps(dict(comment, commit_id=head_sha)))
+    if resp.status_code not in (200, 201):
+        print(f"Failed to post comment on {comment['path']}:{comment['line']}: {resp.status_code} {resp.reason}")
+        return False
+    return True
 
 
 def post_review_comment(review_data):
@@ -193,12 +515,11 @@ def post_review_comment(review_data):
     if not token:
         print("Warning: GITHUB_TOKEN not set, cannot post review")
         return
+    SESSION.headers['Authorization'] = f'Bearer {token}'
     if not head_sha:
-        result = subprocess.run(
-            ['gh', 'pr', 'view', pr_number, '--repo', repo, '--json', 'headRefOid', '-q', '.headRefOid'],
-            capture_output=True, text=True, env=os.environ
-        )
-        head_sha = (result.stdout or '').strip()
+        resp = SESSION.get(f"https://api.github.com/repos/{repo}/pulls/{pr_number}")
+        if resp.ok:
+            head_sha = _loads(resp.content).get('head', {}).get('sha', '')
     if not head_sha:
         print("Warning: Could not get head SHA for review")
         head_sha = None
@@ -212,6 +533,7 @@ def post_review_comment(review_data):
     review_body = _review_body_summary(review_data, issues_without_line)
 
     comments_payload = []
+    comment_issues = []
     for issue in inline_issues:
         path = issue['file']
         line = int(issue['line']) if isinstance(issue['line'], (int, float)) else int(issue.get('line', 0))
@@ -223,6 +545,7 @@ def post_review_comment(review_data):
             "side": "RIGHT",
             "body": _inline_comment_body(issue),
         })
+        comment_issues.append(issue)
 
     payload = {
         "body": review_body,
@@ -233,36 +556,45 @@ def post_review_comment(review_data):
         payload["commit_id"] = head_sha
 
     url = f"https://api.github.com/repos/{owner}/{repo_name}/pulls/{pr_number}/reviews"
-    req = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'), method='POST')
-    req.add_header('Accept', 'application/vnd.github+json')
-    req.add_header('Authorization', f'Bearer {token}')
-    req.add_header('X-GitHub-Api-Version', '2022-11-28')
-    req.add_header('Content-Type', 'application/json')
-
-    try:
-        with urllib.request.urlopen(req) as resp:
-            if resp.status in (200, 201):
-                print(f"✅ Review posted with {len(comments_payload)} inline comment(s)")
-            else:
-                print(f"Unexpected status {resp.status}")
-    except urllib.error.HTTPError as e:
-        err_body = e.read().decode('utf-8', errors='replace')
-        print(f"Failed to post review: {e.code} {e.reason}")
-        print(err_body[:500])
+    resp = SESSION.post(url, data=_dumps(payload))
+    if resp.status_code in (200, 201):
+        print(f"✅ Review posted with {len(comments_payload)} inline comment(s)")
+    elif resp.ok:
+        print(f"Unexpected status {resp.status_code}")
+    else:
+        print(f"Failed to post review: {resp.status_code} {resp.reason}")
+        print(resp.text[:500])
+        # 422 usually means one comment's line is outside the diff, which rejects
+        # the whole review; post comments individually so the valid ones land
+        failed_issues = comment_issues
+        posted_note = f"inline review failed: {resp.status_code}"
+        if resp.status_code == 422 and comments_payload and head_sha:
+            comments_url = f"https://api.github.com/repos/{owner}/{repo_name}/pulls/{pr_number}/comments"
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(
+                    lambda c: _post_inline_comment(comments_url, head_sha, c),
+                    comments_payload
+                ))
+            failed_issues = [i for i, ok in zip(comment_issues, results) if not ok]
+            posted_note = f"posted {len(comments_payload) - len(failed_issues)} of {len(comments_payload)} inline comment(s) individually"
+            print(posted_note.capitalize())
+        # Un-posted inline issues go in the body with the line-less ones, above the footer
+        review_body = _review_body_summary(review_data, issues_without_line + failed_issues)
         # Fallback: post as single PR comment so the review is not lost
-        fallback = f"""## 🤖 AI Code Review (fallback — inline review failed)
+        fallback = f"""## 🤖 AI Code Review (fallback — {posted_note})
 
 **Summary:** {review_data.get('summary', '')}
 
 **Overall Severity:** {review_data.get('severity', 'low').upper()}
 
-See full details below. (Posting inline comments failed: {e.code})
+See full details below.
 """
-        with open('/tmp/review_comment.md', 'w') as f:
-            f.write(fallback + "\n\n" + review_body)
-        subprocess.run([
-            'gh', 'pr', 'comment', pr_number, '--repo', repo, '--body-file', '/tmp/review_comment.md'
-        ], env=os.environ)
+        resp = SESSION.post(
+            f"https://api.github.com/repos/{owner}/{repo_name}/issues/{pr_number}/comments",
+            data=_dumps({"body": ''.join([fallback, "\n\n", review_body])})
+        )
+        if not resp.ok:
+            print(f"Failed to post fallback comment: {resp.status_code} {resp.reason}")
 
     # Log findings but never fail the build — review is advisory only
     critical_issues = [i for i in issues if i.get('severity') == 'critical']
@@ -274,23 +606,25 @@ def main():
     print("🔍 Starting AI code review...")
     
     # Get diff and changed files
-    diff = get_diff()
-    changed_files = get_changed_files()
+    diff, hunk_ranges = get_diff(get_base_ref())
+    changed_files = get_changed_files(hunk_ranges)
     
-    if not changed_files:
+    if not diff.strip() or not changed_files:
         print("No Swift files changed, skipping review")
         return
     
+    swift_files = [f for f in changed_files if f.endswith('.swift')]
+    if not swift_files:
+        print("Doc-only PR, skipping AI review")
+        return
+    
     print(f"Reviewing {len(changed_files)} file(s)...")
     
     # Get file contents for context
-    file_contents = {
-        filepath: get_file_content(filepath)
-        for filepath in changed_files
-    }
+    file_contents = get_file_contents(changed_files)
     
     # Get AI review
-    review_text = review_code(diff, changed_files, file_contents)
+    review_text = review_code(diff, changed_files, file_contents, hunk_ranges)
     
     # Parse and post
     try: